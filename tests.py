@@ -1,39 +1,369 @@
+import copy
+import pickle
 import tempfile
 import unittest
+import wsgiref.simple_server
 
-from os import listdir, path
-from threading import Thread
+from concurrent.futures import Future
+from functools import partial
+from os import _exit, listdir, path
+from pathlib import Path
+from threading import Event, Thread
 from time import sleep, time
+from unittest import mock
+from urllib.request import urlopen
 
 import tutube
 
 TEST_URL = "https://www.youtube.com/watch?v=C0DPdy98e4c"
 
 
+def fake_extract(ydl_opts, url):
+    """Stands in for tutube._extract_in_worker in the extraction processes."""
+    return {"webpage_url": url}
+
+
 class CachingDownloaderTests(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.down = tutube.CachingDownloader(self.tempdir.name)
+        self.info = self.down.VideoInfo(TEST_URL, "youtube", "C0DPdy98e4c",
+                                        "TEST VIDEO", "mp3")
+
+    def tearDown(self):
+        self.down._download_pool.shutdown()
+        self.tempdir.cleanup()
 
     def test_simple_download(self):
-        with tempfile.TemporaryDirectory() as tempdir:
-            down = tutube.CachingDownloader(tempdir)
-            videos = down.get_videos(TEST_URL)
-            self.assertEqual(len(videos), 1)
-            video = videos[0]
-            self.assertEqual("C0DPdy98e4c", video.id)
-            self.assertEqual("youtube", video.provider)
-            self.assertEqual(TEST_URL, video.url)
-            self.assertEqual("TEST VIDEO", video.title)
-            videopath = down.cache_dir / video.path
-            self.assertTrue(videopath.exists())
-            self.assertGreater(videopath.stat().st_size, 0)
-            videodir, videofile = path.split(videopath)
-            self.assertEqual(listdir(videodir), ["C0DPdy98e4c.mp3"])
+        down = self.down
+        videos = down.get_videos(TEST_URL)
+        self.assertEqual(len(videos), 1)
+        video = videos[0]
+        self.assertEqual("C0DPdy98e4c", video.id)
+        self.assertEqual("youtube", video.provider)
+        self.assertEqual(TEST_URL, video.url)
+        self.assertEqual("TEST VIDEO", video.title)
+        videopath = down.cache_dir / video.path
+        self.assertTrue(videopath.exists())
+        self.assertGreater(videopath.stat().st_size, 0)
+        videodir, videofile = path.split(videopath)
+        self.assertEqual(listdir(videodir), ["C0DPdy98e4c.mp3"])
+
+    def test_info_cache(self):
+        down = self.down
+        info = self.info._replace(size=1234)
+        down._cache_info(TEST_URL, [info])
+        # Served from memory, no network access
+        self.assertEqual(down.extract_info(TEST_URL), [info])
+        # Survives restarts through the on-disk index
+        other = tutube.CachingDownloader(self.tempdir.name)
+        self.assertEqual(other.extract_info(TEST_URL), [info])
+        down._uncache_info(TEST_URL)
+        self.assertIsNone(down._cached_info(TEST_URL))
+        # Expires, in memory and on disk
+        down.info_ttl = -1
+        down._cache_info(TEST_URL, [info])
+        self.assertIsNone(down._cached_info(TEST_URL))
+        restarted = tutube.CachingDownloader(self.tempdir.name)
+        self.assertIsNone(restarted._cached_info(TEST_URL))
+        self.assertEqual(listdir(down.index_dir),
+                         [down._index_path(TEST_URL).name])
+
+    def test_download_error_uncaches(self):
+        url = "https://invalid.invalid/video"
+        down = self.down
+        info = down.VideoInfo(url, "generic", "video", "VIDEO", "mp3")
+        down._cache_info(url, [info])
+        down._extract = lambda url: [(info, None)]
+        [(_, future)] = down.start_videos(url)
+        self.assertIsInstance(future.exception(), tutube.CannotDownload)
+        # Wait for the done callbacks
+        down._download_pool.shutdown()
+        self.assertIsNone(down._cached_info(url))
+
+    def test_failed_download_removed(self):
+        down, info = self.down, self.info
+        audio_file = down.cache_dir / info.path
+
+        def process_info(entry):
+            # ffmpeg dying halfway through
+            audio_file.write_bytes(b"x" * 1000)
+            raise tutube.youtube_dl.utils.DownloadError("ffmpeg failed")
+
+        down._extract = lambda url: [(info, {"id": info.id})]
+        with mock.patch.object(tutube.youtube_dl.YoutubeDL, "process_info",
+                               side_effect=process_info):
+            [(_, future)] = down.start_videos(TEST_URL)
+            self.assertIsInstance(future.exception(), tutube.CannotDownload)
+        self.assertFalse(audio_file.exists())
+
+    def test_extract_while_downloading(self):
+        down = tutube.CachingDownloader(self.tempdir.name, ydl_instances=2)
+        started = Event()
+        release = Event()
+
+        def extract_info(url, download=False):
+            video_id = url.rsplit("=", 1)[1]
+            return {"webpage_url": url, "extractor": "youtube",
+                    "id": video_id, "title": video_id}
+
+        def process_info(entry):
+            started.set()
+            release.wait()
+            raise tutube.youtube_dl.utils.DownloadError("interrupted")
+
+        YoutubeDL = tutube.youtube_dl.YoutubeDL
+        with mock.patch.object(YoutubeDL, "extract_info",
+                               side_effect=extract_info), \
+                mock.patch.object(YoutubeDL, "process_info",
+                                  side_effect=process_info):
+            try:
+                # More downloads than download threads
+                for video_id in ("a", "b"):
+                    down.start_videos(TEST_URL[:-11] + video_id)
+                started.wait()
+                sleep(.1)
+                extraction = Thread(target=down.extract_info,
+                                    args=[TEST_URL[:-11] + "d"])
+                extraction.start()
+                extraction.join(2)
+                self.assertFalse(extraction.is_alive())
+            finally:
+                release.set()
+                down._download_pool.shutdown()
+
+    def test_extract_pool_restart(self):
+        down = tutube.CachingDownloader(self.tempdir.name,
+                                        extract_processes=1)
+        new_extract_pool = down._new_extract_pool
+        pools = [down._extract_pool]
+
+        def new_pool(dying):
+            pool = new_extract_pool()
+            if dying:
+                # Kill the worker
+                pool.submit(_exit, 1)
+            pools.append(pool)
+            return pool
+
+        pools[0].submit(_exit, 1)
+        try:
+            with mock.patch.object(tutube, "_extract_in_worker",
+                                   fake_extract), \
+                    mock.patch.object(down, "_new_extract_pool",
+                                      side_effect=partial(new_pool, False)):
+                # Retried in a new pool
+                self.assertEqual(down._extract_in_pool(TEST_URL),
+                                 fake_extract(None, TEST_URL))
+                self.assertEqual(len(pools), 2)
+                self.assertIs(down._extract_pool, pools[1])
+                # Given up when the new pool dies too
+                pools[1].submit(_exit, 1)
+                down._new_extract_pool.side_effect = partial(new_pool, True)
+                with self.assertRaisesRegex(tutube.CannotDownload,
+                                            "the extraction process died"):
+                    down._extract_in_pool(TEST_URL)
+                self.assertEqual(len(pools), 4)
+        finally:
+            for pool in pools:
+                pool.shutdown()
+
+    def test_size_recorded(self):
+        down, info = self.down, self.info
+        audio_file = down.cache_dir / info.path
+        audio_file.parent.mkdir()
+        audio_file.write_bytes(b"x" * 1234)
+        down._cache_info(TEST_URL, [info])
+        [(_, future)] = down.start_videos(TEST_URL)
+        self.assertEqual(future.result().size, 1234)
+        self.assertEqual(down._cached_info(TEST_URL)[0].size, 1234)
+        restarted = tutube.CachingDownloader(self.tempdir.name)
+        self.assertEqual(restarted._cached_info(TEST_URL)[0].size, 1234)
+
+    def test_cached_video_checked_once(self):
+        down, info = self.down, self.info
+        audio_file = down.cache_dir / info.path
+        audio_file.parent.mkdir()
+        audio_file.write_bytes(b"x" * 1234)
+        down._cache_info(TEST_URL, [info])
+        exists = Path.exists
+        with mock.patch.object(Path, "exists", autospec=True,
+                               side_effect=exists) as mock_exists:
+            [(_, future)] = down.start_videos(TEST_URL)
+            self.assertEqual(future.result().size, 1234)
+        self.assertEqual(mock_exists.call_count, 1)
+
+    def test_size_waits_for_other_process(self):
+        down = tutube.CachingDownloader(self.tempdir.name, multi_process=True)
+        info = self.info
+        audio_file = down.cache_dir / info.path
+        audio_file.parent.mkdir()
+        audio_file.write_bytes(b"x" * 1000)
+        down._cache_info(TEST_URL, [info])
+        locked = Event()
+
+        def encode():
+            # Another process, still writing the file
+            with tutube.lock(str(audio_file.with_suffix(".lock"))):
+                locked.set()
+                sleep(.2)
+                with audio_file.open("ab") as fp:
+                    fp.write(b"x" * 234)
+        encoder = Thread(target=encode)
+        encoder.start()
+        locked.wait()
+        [(_, future)] = down.start_videos(TEST_URL)
+        self.assertEqual(future.result().size, 1234)
+        encoder.join()
+
+    def test_video_info_pickle(self):
+        info = self.info._replace(size=1234)
+        self.assertEqual(pickle.loads(pickle.dumps(info)), info)
+        self.assertEqual(copy.copy(info), info)
+        self.assertEqual(info.path, Path("youtube/C0DPdy98e4c.mp3"))
+        self.assertEqual(info._replace(ext="m4a").path,
+                         Path("youtube/C0DPdy98e4c.m4a"))
+        self.assertEqual(type(info)._make(info[:-1]), info)
+
+    def test_video_locks_released(self):
+        down, info = self.down, self.info
+        with down._video_lock(info):
+            self.assertIs(down._video_lock(info), down._video_lock(info))
+            self.assertEqual(len(down._locks), 1)
+        self.assertEqual(len(down._locks), 0)
+
+    def test_single_flight(self):
+        calls = []
+
+        def slow_extract(url):
+            calls.append(url)
+            sleep(.2)
+            return []
+
+        self.down._extract = slow_extract
+        threads = [Thread(target=self.down.extract_info, args=[TEST_URL])
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [TEST_URL])
+
+
+class YoutubeDownloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.app = tutube.YoutubeDownloader(self.tempdir.name)
+        self.environ = {"REQUEST_METHOD": "GET",
+                        "PATH_INFO": "/https://www.youtube.com/watch",
+                        "QUERY_STRING": "v=C0DPdy98e4c"}
+
+    def tearDown(self):
+        self.app.downloader._download_pool.shutdown()
+        self.tempdir.cleanup()
+
+    def get_while_encoding(self, ext):
+        """GET a video whose file is still being written.
+
+        Returns the response headers, whether the download was done when
+        the response started, and the body.
+        """
+        downloader = self.app.downloader
+        info = downloader.VideoInfo(TEST_URL, "youtube", "C0DPdy98e4c",
+                                    "TEST VIDEO", ext)
+        audio_file = downloader.cache_dir / info.path
+        audio_file.parent.mkdir()
+        future = Future()
+
+        def encode():
+            with audio_file.open("wb") as fp:
+                for _ in range(5):
+                    fp.write(b"x" * 1000)
+                    fp.flush()
+                    sleep(.05)
+            future.set_result(info._replace(size=5000))
+        downloader.start_videos = lambda url: [(info, future)]
+        encoder = Thread(target=encode)
+        encoder.start()
+        response = {}
+
+        def start_response(status, headers):
+            response["headers"] = dict(headers)
+            response["done"] = future.done()
+        result = self.app(self.environ, start_response)
+        body = b"".join(result)
+        if hasattr(result, "close"):
+            result.close()
+        encoder.join()
+        return response["headers"], response["done"], body
+
+    def test_unsatisfiable_range(self):
+        downloader = self.app.downloader
+        info = downloader.VideoInfo(TEST_URL, "youtube", "C0DPdy98e4c",
+                                    "TEST VIDEO", "mp3", 1000)
+        future = Future()
+        future.set_result(info)
+        downloader.start_videos = lambda url: [(info, future)]
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+        self.app(dict(self.environ, HTTP_RANGE="bytes=1000-"), start_response)
+        self.assertTrue(response["status"].startswith("416"))
+        self.assertEqual(response["headers"]["Content-Range"], "bytes */1000")
+
+    def test_stream_mp3(self):
+        headers, done, body = self.get_while_encoding("mp3")
+        self.assertFalse(done)
+        self.assertNotIn("Content-Length", headers)
+        self.assertEqual(headers["Content-Type"], "audio/mpeg")
+        self.assertEqual(body, b"x" * 5000)
+
+    def test_wait_for_m4a(self):
+        headers, done, body = self.get_while_encoding("m4a")
+        self.assertTrue(done)
+        self.assertEqual(headers["Content-Length"], "5000")
+        self.assertEqual(headers["Content-Type"], "audio/mp4")
+        self.assertEqual(body, b"x" * 5000)
 
 
 class MiscTests(unittest.TestCase):
 
+    def test_normalize_url(self):
+        self.assertEqual(tutube.normalize_url(" HTTPS://WWW.YouTube.com"
+                                              "/watch?v=C0DPdy98e4c#t=1 "),
+                         TEST_URL)
+
+    def test_parse_range(self):
+        self.assertIsNone(tutube.parse_range(None, 100))
+        self.assertIsNone(tutube.parse_range("bytes=0-1,5-6", 100))
+        self.assertIsNone(tutube.parse_range("bytes=a-b", 100))
+        self.assertIsNone(tutube.parse_range("bytes=50-10", 100))
+        self.assertEqual(tutube.parse_range("bytes=10-19", 100), (10, 19))
+        self.assertEqual(tutube.parse_range("bytes=10-", 100), (10, 99))
+        self.assertEqual(tutube.parse_range("bytes=90-500", 100), (90, 99))
+        self.assertEqual(tutube.parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(tutube.parse_range("bytes=-500", 100), (0, 99))
+        with self.assertRaises(ValueError):
+            tutube.parse_range("bytes=100-", 100)
+        with self.assertRaises(ValueError):
+            tutube.parse_range("bytes=-0", 100)
+        with self.assertRaises(ValueError):
+            tutube.parse_range("bytes=-5", 0)
+        with self.assertRaises(ValueError):
+            tutube.parse_range("bytes=0-", 0)
+
+    def test_file_slice(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(bytes(range(100)))
+            fslice = tutube.FileSlice(fp, 10, 20)
+            self.assertEqual(fslice.read(5), bytes(range(10, 15)))
+            self.assertEqual(fslice.read(), bytes(range(15, 30)))
+            self.assertEqual(fslice.read(), b"")
+
     def test_lock(self):
         with tempfile.TemporaryDirectory() as td:
             lf = path.join(td, "lockity.lock")
@@ -64,3 +394,80 @@ class MiscTests(unittest.TestCase):
                 # If we could get the lock that means that the sleep thread
                 # has finished
                 self.assertFalse(sleepthread.is_alive())
+
+    def test_thread_pool_server(self):
+        running = []
+        peak = []
+
+        def app(environ, start_response):
+            running.append(None)
+            peak.append(len(running))
+            sleep(.1)
+            running.pop()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"hello"]
+        server = wsgiref.simple_server.make_server(
+            "127.0.0.1", 0, app,
+            partial(tutube.ThreadingWSGIServer, max_workers=2))
+        Thread(target=server.serve_forever, daemon=True).start()
+        bodies = []
+
+        def fetch():
+            with urlopen(url) as resp:
+                bodies.append(resp.read())
+        try:
+            url = "http://127.0.0.1:%d/" % server.server_port
+            clients = [Thread(target=fetch) for _ in range(6)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(bodies, [b"hello"] * 6)
+        self.assertEqual(max(peak), 2)
+
+    def test_follow(self):
+        chunks = [bytes([i]) * 1000 for i in range(10)]
+        future = Future()
+        with tempfile.NamedTemporaryFile() as fp:
+            def write():
+                for chunk in chunks:
+                    fp.write(chunk)
+                    fp.flush()
+                    sleep(.02)
+                future.set_result(None)
+            writer = Thread(target=write)
+            writer.start()
+            body = b"".join(tutube.follow(fp.name, future, blksize=300,
+                                          interval=.01))
+            writer.join()
+        self.assertEqual(body, b"".join(chunks))
+
+    def test_sendfile(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(bytes(range(256)) * 1024)
+            fp.flush()
+
+            def app(environ, start_response):
+                fslice = tutube.FileSlice(fp, 10, 100000)
+                start_response("200 OK", [("Content-Length", "100000")])
+                return environ["wsgi.file_wrapper"](fslice, 65536)
+            server = wsgiref.simple_server.make_server(
+                "127.0.0.1", 0, app, tutube.ThreadingWSGIServer,
+                tutube.SendfileRequestHandler)
+            Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                url = "http://127.0.0.1:%d/" % server.server_port
+                with mock.patch.object(tutube, "sendfile",
+                                       wraps=tutube.sendfile) as sendfile:
+                    with urlopen(url) as resp:
+                        body = resp.read()
+            finally:
+                server.shutdown()
+                server.server_close()
+        self.assertEqual(body, (bytes(range(256)) * 1024)[10:100010])
+        # The file was sent with sendfile(2), not read by the handler
+        self.assertTrue(sendfile.called)
+        self.assertEqual(sendfile.call_args_list[0][0][2:], (10, 100000))
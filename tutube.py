@@ -1,29 +1,41 @@
 #!/usr/bin/python3
 
 import fcntl
+import hashlib
 import http.server
+import json
 import logging
+import multiprocessing
+import queue
+import socket
+import tempfile
+import threading
+import time
 import wsgiref.simple_server
 
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import contextmanager
+from functools import partial
 from http import HTTPStatus
-from os import unlink
+from os import cpu_count, replace, sendfile, unlink
 from pathlib import Path
 from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, urlunsplit
+from weakref import WeakValueDictionary
 from wsgiref.headers import Headers
 from wsgiref.util import FileWrapper
 
 import youtube_dl
 
-logging.basicConfig(level=logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
+logger = logging.getLogger(__name__)
 dl_logger = logging.getLogger("youtube-dl")
-dl_logger.addHandler(handler)
-dl_logger.setLevel(logging.WARNING)
+
+#: Size of the chunks audio files are read and sent in
+BLOCK_SIZE = 256 * 1024
 
 
 @contextmanager
@@ -40,6 +52,88 @@ def lock(path):
                 pass
 
 
+def normalize_url(url):
+    """Return a canonical form of `url`, suitable as a cache key."""
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path, parts.query, ""))
+
+
+def parse_range(value, size):
+    """Parse a HTTP Range header for a resource of `size` bytes.
+
+    Returns the (first, last) byte offsets to send, both inclusive, or None
+    if the header is absent or unsupported and the whole resource should be
+    sent. Raises ValueError if the range cannot be satisfied.
+    """
+    # Multiple ranges would need a multipart response, send everything
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, sep, last = value[len("bytes="):].strip().partition("-")
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if not sep or (first is None and last is None):
+        return None
+    if first is None:
+        # Suffix range: the last `last` bytes
+        if last == 0:
+            raise ValueError("empty suffix range")
+        if size == 0:
+            raise ValueError("empty resource")
+        return max(size - last, 0), size - 1
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError("range starts past the end of the resource")
+    if last is None or last >= size:
+        last = size - 1
+    return first, last
+
+
+class FileSlice(object):
+    """Read-only view of `length` bytes of `fp`, starting at `offset`."""
+
+    def __init__(self, fp, offset, length):
+        self.fp = fp
+        self.offset = offset
+        self.remaining = length
+        fp.seek(offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def tell(self):
+        return self.fp.tell()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+
+
+def follow(path, future, blksize=BLOCK_SIZE, interval=.1):
+    """Yield the contents of `path` as it is written, until `future` is done.
+    """
+    with open(path, "rb") as fp:
+        while True:
+            done = future.done()
+            data = fp.read(blksize)
+            if data:
+                yield data
+            elif done:
+                return
+            else:
+                wait([future], timeout=interval)
+
+
 class ThreadingSimpleServer(ThreadingMixIn, http.server.HTTPServer):
     pass
 
@@ -48,74 +142,512 @@ class CannotDownload(Exception):
     pass
 
 
+#: YoutubeDL instance of a metadata extraction worker process
+_worker_ydl = None
+
+
+def _extract_in_worker(ydl_opts, url):
+    """Extract the metadata of `url`, in a worker process."""
+    global _worker_ydl
+    if _worker_ydl is None:
+        # Loggers can't be pickled on every supported Python version
+        _worker_ydl = youtube_dl.YoutubeDL(dict(ydl_opts, logger=dl_logger))
+    try:
+        return _worker_ydl.extract_info(url, download=False)
+    except youtube_dl.utils.DownloadError as exc:
+        # youtube-dl's exceptions don't survive pickling
+        raise CannotDownload(str(exc))
+
+
+#: Formats that can be played while they are being written. The mp4
+#: muxer only writes the size of the media data and the index once done.
+STREAMABLE = {"mp3"}
+
+#: Content-Type of the audio files, by extension
+CONTENT_TYPES = {
+    "mp3": "audio/mpeg",
+    "m4a": "audio/mp4",
+}
+
+
 class CachingDownloader(object):
 
     class VideoInfo(namedtuple("VideoInfo",
-                               ("url", "provider", "id", "title"))):
-        @property
-        def path(self):
-            return Path(self.provider) / ("%s.mp3" % self.id)
+                               ("url", "provider", "id", "title", "ext",
+                                "size", "path"))):
+
+        __slots__ = ()
+
+        def __new__(cls, url, provider, id, title, ext, size=None):
+            # The path is used several times per request, compute it once
+            path = Path(provider) / ("%s.%s" % (id, ext))
+            return super().__new__(cls, url, provider, id, title, ext, size,
+                                   path)
+
+        def __getnewargs__(self):
+            # For pickle and copy, __new__ computes the path
+            return tuple(self)[:-1]
+
+        def _asdict(self):
+            # The path is derived from the other fields
+            fields = super()._asdict()
+            del fields["path"]
+            return fields
+
+        # The namedtuple versions bypass __new__, leaving a stale path
+        @classmethod
+        def _make(cls, iterable):
+            return cls(*iterable)
+
+        def _replace(self, **kwargs):
+            return type(self)(**dict(self._asdict(), **kwargs))
 
-    def __init__(self, cache_dir):
+    #: How long (in seconds) extracted metadata is kept in memory
+    info_ttl = 24 * 60 * 60
+    #: Maximum number of URLs whose metadata is kept in memory
+    info_cache_size = 1024
+
+    def __init__(self, cache_dir, ydl_instances=4, multi_process=False,
+                 transcode=True, extract_processes=0):
 
         self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Provider directories known to exist
+        self._provider_dirs = set()
+        # Metadata of already seen URLs, survives restarts
+        self.index_dir = self.cache_dir / ".url_index"
+        self.index_dir.mkdir(exist_ok=True)
+        # Lock files are only needed if other processes share the cache
+        self.multi_process = multi_process
+        # (provider, id) -> lock held while downloading the video, entries
+        # go away once nobody holds or waits for the lock
+        self._locks = WeakValueDictionary()
+        self._locks_guard = threading.Lock()
+        # url -> (expiry timestamp, [VideoInfo, ...])
+        self._info_cache = OrderedDict()
+        self._info_cache_lock = threading.Lock()
+
+        if transcode:
+            self.audio_ext = "mp3"
+            audio_format = "bestaudio/best"
+        else:
+            # AAC is copied as is into a m4a, anything else is converted
+            self.audio_ext = "m4a"
+            audio_format = "bestaudio[ext=m4a]/bestaudio/best"
 
         ydl_opts = {
                 'outtmpl': str(self.cache_dir) + '/%(extractor)s/%(id)s',
+                'format': audio_format,
                 'noplaylist': True,
                 'youtube_include_dash_manifest': False,
                 'quiet': True,
                 # ~ 'writethumbnail': True,
                 'postprocessors': [{
                     'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
+                    'preferredcodec': self.audio_ext,
                     'preferredquality': '192',
                 }],
                 'logger': dl_logger,
                 # ~ 'progress_hooks': [self.progress_hook],
             }
 
-        self.ydl = youtube_dl.YoutubeDL(ydl_opts)
+        # Long-lived YoutubeDL instances shared by the request threads, so
+        # that concurrent requests don't wait on each other and extractor
+        # state (player JS cache...) survives between requests
+        self._ydl_pool = queue.Queue()
+        for _ in range(ydl_instances):
+            ydl = youtube_dl.YoutubeDL(ydl_opts)
+            # Instantiate the extractor now rather than on the first request
+            ydl.get_info_extractor("Youtube")
+            self._ydl_pool.put(ydl)
+
+        # Extraction is mostly CPU bound (JS interpretation, parsing), let
+        # it run in other processes so that it doesn't hold the GIL
+        self.extract_processes = extract_processes
+        if extract_processes:
+            self._worker_opts = {key: value for key, value in ydl_opts.items()
+                                 if key != 'logger'}
+            self._extract_pool = self._new_extract_pool()
+            self._extract_pool_lock = threading.Lock()
+        else:
+            self._extract_pool = None
+
+        # A batch holds its YoutubeDL instance for a whole playlist, keep one
+        # for extraction so that downloads can't starve it
+        download_threads = ydl_instances
+        if self._extract_pool is None:
+            download_threads -= 1
+        if download_threads < 1:
+            raise ValueError("extracting in process needs ydl_instances >= 2")
+        self._download_pool = ThreadPoolExecutor(max_workers=download_threads)
+        # audio path -> Future of the download in progress
+        self._downloads = {}
+        self._downloads_lock = threading.Lock()
+        # url -> Future of the metadata extraction in progress
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def _new_extract_pool(self):
+        # Forking from a process that already runs threads could leave the
+        # children with locks held by threads that don't exist there
+        return ProcessPoolExecutor(
+            max_workers=self.extract_processes,
+            mp_context=multiprocessing.get_context("forkserver"))
+
+    def _extract_in_pool(self, url):
+        for _ in range(2):
+            pool = self._extract_pool
+            try:
+                return pool.submit(_extract_in_worker,
+                                   self._worker_opts, url).result()
+            except BrokenProcessPool:
+                logger.warning("An extraction process died, restarting them")
+                with self._extract_pool_lock:
+                    # Unless another thread already did
+                    if self._extract_pool is pool:
+                        pool.shutdown(wait=False)
+                        self._extract_pool = self._new_extract_pool()
+        raise CannotDownload("the extraction process died")
+
+    @contextmanager
+    def _ydl(self):
+        ydl = self._ydl_pool.get()
+        try:
+            yield ydl
+        finally:
+            self._ydl_pool.put(ydl)
+
+    def _index_path(self, url):
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+        return self.index_dir / ("%s.json" % digest)
 
-    def extract_info(self, url):
+    def _read_index(self, url):
+        """Return the (expiry timestamp, [VideoInfo, ...]) stored for `url`
+        in the index, or None.
+        """
         try:
-            with self.ydl:
-                result = self.ydl.extract_info(url, download=False)
-        except youtube_dl.utils.DownloadError as exc:
-            raise CannotDownload(str(exc))
+            with self._index_path(url).open() as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        # The hash is short, make sure it's the right URL
+        if index.get("url") != url:
+            return None
+        expiry = index.get("expires", 0)
+        if expiry < time.time():
+            return None
+        try:
+            return expiry, [self.VideoInfo(**video)
+                            for video in index["videos"]]
+        except (KeyError, TypeError):
+            # Written by an older version
+            return None
+
+    def _write_index(self, url, infos, ttl):
+        index = {"url": url,
+                 "expires": time.time() + ttl,
+                 "videos": [info._asdict() for info in infos]}
+        # The index is only an optimization, don't fail the request for it
+        try:
+            fp = tempfile.NamedTemporaryFile("w", dir=str(self.index_dir),
+                                             suffix=".tmp", delete=False)
+        except OSError:
+            logger.exception("Cannot write the index entry of %s", url)
+            return
+        try:
+            with fp:
+                json.dump(index, fp)
+            replace(fp.name, str(self._index_path(url)))
+        except OSError:
+            logger.exception("Cannot write the index entry of %s", url)
+            try:
+                unlink(fp.name)
+            except OSError:
+                pass
+
+    def _cached_info(self, url):
+        with self._info_cache_lock:
+            try:
+                expiry, infos = self._info_cache[url]
+            except KeyError:
+                infos = None
+            else:
+                if expiry < time.monotonic():
+                    del self._info_cache[url]
+                    infos = None
+                else:
+                    self._info_cache.move_to_end(url)
+        if infos is None:
+            indexed = self._read_index(url)
+            if indexed is not None:
+                expiry, infos = indexed
+                self._cache_info(url, infos, ttl=expiry - time.time(),
+                                 persist=False)
+        return infos
+
+    def _cache_info(self, url, infos, ttl=None, persist=True):
+        if ttl is None:
+            ttl = self.info_ttl
+        with self._info_cache_lock:
+            self._info_cache[url] = (time.monotonic() + ttl, infos)
+            self._info_cache.move_to_end(url)
+            while len(self._info_cache) > self.info_cache_size:
+                self._info_cache.popitem(last=False)
+        if persist:
+            self._write_index(url, infos, ttl)
+
+    def _uncache_info(self, url):
+        with self._info_cache_lock:
+            self._info_cache.pop(url, None)
+        try:
+            self._index_path(url).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _extract(self, url):
+        """Fetch the metadata of the video(s) at `url`.
+
+        Returns a list of (VideoInfo, entry) pairs where entry is the
+        resolved youtube-dl info dict, which can be downloaded without
+        querying the provider again.
+        """
+        try:
+            if self._extract_pool is None:
+                with self._ydl() as ydl:
+                    try:
+                        result = ydl.extract_info(url, download=False)
+                    except youtube_dl.utils.DownloadError as exc:
+                        raise CannotDownload(str(exc))
+            else:
+                result = self._extract_in_pool(url)
+        except CannotDownload:
+            self._uncache_info(url)
+            raise
         if 'entries' in result:
-            infos = result['entries']
+            entries = result['entries']
         else:
             # Just a video
-            infos = [result]
-        return [self.VideoInfo(i["webpage_url"], i["extractor"],
-                               i["id"], i["title"])
-                for i in infos]
-
-    def _download(self, info):
-        mp3_path = self.cache_dir / info.path
-        mp3_path.parent.mkdir(exist_ok=True)
-        if not mp3_path.exists():
-            logging.info("%r: Video not in cache, downloading", info.title)
-            with lock(mp3_path.with_suffix(".lock")), self.ydl:
-                self.ydl.download([info.url])
-        return info
+            entries = [result]
+        pairs = [(self.VideoInfo(i["webpage_url"], i["extractor"],
+                                 i["id"], i["title"], self.audio_ext), i)
+                 for i in entries]
+        self._cache_info(url, [info for info, _ in pairs])
+        return pairs
+
+    def _extract_once(self, url):
+        """Like _extract, but concurrent calls for the same URL share a
+        single extraction.
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(url)
+            owner = future is None
+            if owner:
+                future = self._inflight[url] = Future()
+        if not owner:
+            return future.result()
+        try:
+            pairs = self._extract(url)
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(pairs)
+            return pairs
+        finally:
+            with self._inflight_lock:
+                del self._inflight[url]
+
+    def extract_info(self, url):
+        url = normalize_url(url)
+        infos = self._cached_info(url)
+        if infos is not None:
+            return infos
+        return [info for info, _ in self._extract_once(url)]
+
+    def _video_lock(self, info):
+        if self.multi_process:
+            return lock((self.cache_dir / info.path).with_suffix(".lock"))
+        key = info.provider, info.id
+        with self._locks_guard:
+            video_lock = self._locks.get(key)
+            if video_lock is None:
+                video_lock = self._locks[key] = threading.Lock()
+            return video_lock
+
+    def _with_size(self, info):
+        if info.size is not None:
+            return info
+        return info._replace(size=(self.cache_dir / info.path).stat().st_size)
+
+    def _cached_size(self, info):
+        """Like _with_size, for a file found in the cache rather than
+        downloaded by this process.
+        """
+        if info.size is None and self.multi_process:
+            # Wait until whoever is writing it is done
+            with self._video_lock(info):
+                return self._with_size(info)
+        return self._with_size(info)
+
+    def _download(self, ydl, info, entry):
+        audio_path = self.cache_dir / info.path
+        try:
+            if info.provider not in self._provider_dirs:
+                audio_path.parent.mkdir(parents=True, exist_ok=True)
+                self._provider_dirs.add(info.provider)
+            # Another process may be writing the file, only its lock tells
+            if self.multi_process or not audio_path.exists():
+                with self._video_lock(info):
+                    # Someone else may have downloaded it while we were
+                    # waiting
+                    if audio_path.exists():
+                        return self._with_size(info)
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("%r: Video not in cache, downloading",
+                                    info.title)
+                    try:
+                        if entry is None:
+                            ydl.download([info.url])
+                        else:
+                            # The entry is already resolved, this only
+                            # fetches the media itself
+                            ydl.process_info(dict(entry))
+                    except youtube_dl.utils.DownloadError as exc:
+                        # ffmpeg writes to the final name, a truncated file
+                        # would otherwise be served as cached from now on
+                        try:
+                            audio_path.unlink()
+                        except FileNotFoundError:
+                            pass
+                        raise CannotDownload(str(exc))
+            return self._with_size(info)
+        finally:
+            with self._downloads_lock:
+                self._downloads.pop(audio_path, None)
+
+    def _available_paths(self, infos):
+        """Return the paths of the videos found in the cache, or None if
+        one of them is neither in the cache nor being downloaded.
+        """
+        on_disk = set()
+        for info in infos:
+            audio_path = self.cache_dir / info.path
+            with self._downloads_lock:
+                if audio_path in self._downloads:
+                    continue
+            if not audio_path.exists():
+                return None
+            on_disk.add(audio_path)
+        return on_disk
+
+    def _download_batch(self, batch):
+        # A single YoutubeDL instance for the whole batch, so that its HTTP
+        # session and extractor state are shared between the videos
+        with self._ydl() as ydl:
+            for info, entry, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(self._download(ydl, info, entry))
+                except Exception as exc:
+                    future.set_exception(exc)
+
+    def _start_downloads(self, pairs, on_disk=()):
+        """Return a Future for each (VideoInfo, entry) pair, downloading
+        the missing videos in a single background job.
+
+        `on_disk` holds the paths already known to be in the cache.
+        """
+        futures = []
+        cached = []
+        batch = []
+        with self._downloads_lock:
+            for info, entry in pairs:
+                audio_path = self.cache_dir / info.path
+                future = self._downloads.get(audio_path)
+                if future is None:
+                    future = Future()
+                    if audio_path in on_disk or audio_path.exists():
+                        cached.append((info, future))
+                    else:
+                        self._downloads[audio_path] = future
+                        batch.append((info, entry, future))
+                futures.append(future)
+        if batch:
+            self._download_pool.submit(self._download_batch, batch)
+        for info, future in cached:
+            try:
+                future.set_result(self._cached_size(info))
+            except OSError as exc:
+                future.set_exception(CannotDownload(str(exc)))
+        return futures
+
+    def start_videos(self, url):
+        """Start downloading the video(s) at `url` in the background.
+
+        Returns a list of (VideoInfo, Future) pairs, the futures completing
+        once the corresponding audio file is fully written to the cache.
+        """
+        url = normalize_url(url)
+        infos = self._cached_info(url)
+        on_disk = None if infos is None else self._available_paths(infos)
+        if on_disk is None:
+            on_disk = ()
+            # Joins the extraction of a concurrent request if there is one,
+            # so that the resolved entries are only fetched once
+            pairs = self._extract_once(url)
+        else:
+            pairs = [(info, None) for info in infos]
+        infos = [info for info, _ in pairs]
+        futures = self._start_downloads(pairs, on_disk)
+        for future in futures:
+            future.add_done_callback(partial(self._uncache_on_error, url))
+        if any(info.size is None for info in infos):
+            self._record_sizes(url, futures)
+        return list(zip(infos, futures))
+
+    def _uncache_on_error(self, url, future):
+        if not future.cancelled() and isinstance(future.exception(),
+                                                 CannotDownload):
+            self._uncache_info(url)
+
+    def _record_sizes(self, url, futures):
+        """Cache the metadata of `url` again once the downloads are done,
+        with the size of the files.
+        """
+        def update(_):
+            if all(f.done() and not f.cancelled() and f.exception() is None
+                   for f in futures):
+                self._cache_info(url, [f.result() for f in futures])
+
+        pending = [f for f in futures if not f.done()]
+        if not pending:
+            update(None)
+        for future in pending:
+            future.add_done_callback(update)
 
     def get_videos(self, url):
-        return [self._download(i) for i in self.extract_info(url)]
+        url = normalize_url(url)
+        try:
+            return [future.result()
+                    for _, future in self.start_videos(url)]
+        except CannotDownload:
+            self._uncache_info(url)
+            raise
 
 
 class YoutubeDownloader(object):
 
-    def __init__(self, cache_dir):
-        self.downloader = CachingDownloader(cache_dir)
+    def __init__(self, cache_dir, **options):
+        self.downloader = CachingDownloader(cache_dir, **options)
 
     class HTTPError(Exception):
-        def __init__(self, status, reason=None, more=None):
+        def __init__(self, status, reason=None, more=None, headers=()):
             assert status >= 300
             self.status = HTTPStatus(status)
             self.reason = reason or self.status.phrase
             self.more = (more or self.status.description).encode("utf-8")
+            self.headers = list(headers)
 
         def __str__(self):
             return "{} {}".format(self.status, self.reason)
@@ -127,7 +659,8 @@ class YoutubeDownloader(object):
                 raise self.HTTPError(405)
             return meth(environ, start_response)
         except self.HTTPError as hte:
-            start_response(str(hte), [("Content-Type", "text/plain")])
+            start_response(str(hte),
+                           [("Content-Type", "text/plain")] + hte.headers)
             return [hte.more]
 
     def do_GET(self, environ, start_response):
@@ -136,26 +669,163 @@ class YoutubeDownloader(object):
         if video_url == "?":
             raise self.HTTPError(400, more="no URL provided")
         try:
-            videos = self.downloader.get_videos(video_url)
+            videos = self.downloader.start_videos(video_url)
         except CannotDownload as cad:
             raise self.HTTPError(400, "Cannot download", more=str(cad))
 
         if len(videos) != 1:
             raise self.HTTPError(400, more="playlists not supported yet")
-        video = videos[0]
+        video, future = videos[0]
         audio_file = self.downloader.cache_dir / video.path
-        assert audio_file.exists()
-        filesize = audio_file.stat().st_size
+        # Wait for the encoder to start writing the file
+        while (video.ext in STREAMABLE and not future.done()
+               and not audio_file.exists()):
+            wait([future], timeout=.1)
+        if video.ext in STREAMABLE and not future.done():
+            # Still downloading: stream what's been encoded so far, the
+            # length is unknown until the encoder is done
+            headers.add_header("Content-Disposition", "attachment",
+                               filename=video.title)
+            headers.add_header("Content-Type", CONTENT_TYPES[video.ext])
+            start_response("200 OK", headers.items())
+            return follow(audio_file, future)
+        try:
+            video = future.result()
+        except CannotDownload as cad:
+            raise self.HTTPError(400, "Cannot download", more=str(cad))
+        filesize = video.size
+        try:
+            byte_range = parse_range(environ.get("HTTP_RANGE"), filesize)
+        except ValueError as exc:
+            raise self.HTTPError(
+                416, more=str(exc),
+                headers=[("Content-Range", "bytes */%d" % filesize)])
         headers.add_header("Content-Disposition", "attachment",
                            filename=video.title)
-        headers.add_header("Content-Type", "audio/mpeg")
-        headers.add_header("Content-Length", str(filesize))
-        start_response("200 OK", headers.items())
-        return FileWrapper(audio_file.open("rb"))
+        headers.add_header("Content-Type", CONTENT_TYPES[video.ext])
+        headers.add_header("Accept-Ranges", "bytes")
+        fp = audio_file.open("rb")
+        if byte_range is None:
+            status = "200 OK"
+            length = filesize
+        else:
+            first, last = byte_range
+            status = "206 Partial Content"
+            length = last - first + 1
+            headers.add_header("Content-Range",
+                               "bytes %d-%d/%d" % (first, last, filesize))
+            fp = FileSlice(fp, first, length)
+        headers.add_header("Content-Length", str(length))
+        start_response(status, headers.items())
+        file_wrapper = environ.get("wsgi.file_wrapper", FileWrapper)
+        return file_wrapper(fp, BLOCK_SIZE)
+
+
+class ThreadPoolMixIn(object):
+    """Like ThreadingMixIn, but handles requests in a bounded thread pool.
+
+    No more connections are accepted while all the threads are busy, they
+    wait in the listen backlog instead.
+    """
+
+    def __init__(self, *args, max_workers=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if max_workers is None:
+            max_workers = min(32, 2 * (cpu_count() or 1))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._free_workers = threading.BoundedSemaphore(max_workers)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free_workers.release()
 
+    def process_request(self, request, client_address):
+        self._free_workers.acquire()
+        try:
+            self.executor.submit(self.process_request_thread,
+                                 request, client_address)
+        except Exception:
+            self._free_workers.release()
+            raise
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+class ThreadingWSGIServer(ThreadPoolMixIn, wsgiref.simple_server.WSGIServer):
+
+    #: SO_SNDBUF of the client sockets, large enough for big audio chunks
+    send_buffer_size = 1024 * 1024
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                           self.send_buffer_size)
+        return request, client_address
+
+
+class SendfileServerHandler(wsgiref.simple_server.ServerHandler):
+    """Sends files returned through wsgi.file_wrapper with sendfile(2)."""
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        length = self.headers.get("Content-Length")
+        if length is None or not hasattr(filelike, "fileno"):
+            return False
+        connection = self.request_handler.connection
+        # Send the headers and the beginning of the body in full packets
+        cork = getattr(socket, "TCP_CORK", None)
+        if cork is not None:
+            connection.setsockopt(socket.IPPROTO_TCP, cork, 1)
+        try:
+            if not self.headers_sent:
+                self.send_headers()
+            self._flush()
+            out_fd = connection.fileno()
+            in_fd = filelike.fileno()
+            offset = filelike.tell()
+            remaining = int(length)
+            while remaining > 0:
+                sent = sendfile(out_fd, in_fd, offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+                self.bytes_sent += sent
+        finally:
+            if cork is not None:
+                connection.setsockopt(socket.IPPROTO_TCP, cork, 0)
+        return True
 
-class ThreadingWSGIServer(ThreadingMixIn, wsgiref.simple_server.WSGIServer):
-    pass
+
+class SendfileRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    def handle(self):
+        """Handle a single HTTP request"""
+
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=False,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
 
 
 class Binding(namedtuple("Binding", "host port")):
@@ -171,11 +841,43 @@ def main():
                      help="Video cache directory")
     psr.add_argument("--bind", type=Binding, default="127.0.0.1:1994",
                      help="host:port to bind to (default %(default)s)")
+    psr.add_argument("--ydl-instances", type=int, default=4, metavar="N",
+                     help="Number of concurrent youtube-dl instances, one "
+                          "is kept for extraction unless --extract-processes "
+                          "is set (default %(default)s)")
+    psr.add_argument("--multi-process", action="store_true",
+                     help="Use lock files so that several tutube processes "
+                          "can share the cache directory")
+    psr.add_argument("-v", "--verbose", action="count", default=0,
+                     help="Log more (-v: info, -vv: debug, "
+                          "including youtube-dl)")
+    psr.add_argument("--threads-http", type=int, metavar="N",
+                     help="Number of threads serving HTTP requests "
+                          "(default min(32, 2 * CPU count))")
+    psr.add_argument("--extract-processes", type=int, default=0,
+                     metavar="N",
+                     help="Extract video metadata in N worker processes "
+                          "(default: in the request threads)")
+    psr.add_argument("--no-transcode", dest="transcode", action="store_false",
+                     help="Serve AAC audio as m4a instead of converting it "
+                          "to mp3")
     args = psr.parse_args()
-    downloader = YoutubeDownloader(args.cache_dir)
+    levels = (logging.WARNING, logging.INFO, logging.DEBUG)
+    logging.basicConfig(
+        level=levels[min(args.verbose, 2)],
+        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    if args.verbose < 2:
+        dl_logger.setLevel(logging.WARNING)
+    downloader = YoutubeDownloader(args.cache_dir,
+                                   ydl_instances=args.ydl_instances,
+                                   multi_process=args.multi_process,
+                                   transcode=args.transcode,
+                                   extract_processes=args.extract_processes)
+    server_class = partial(ThreadingWSGIServer, max_workers=args.threads_http)
     server = wsgiref.simple_server.make_server(*args.bind,
                                                downloader,
-                                               ThreadingWSGIServer)
+                                               server_class,
+                                               SendfileRequestHandler)
     server.serve_forever()
 
 